@@ -1,5 +1,5 @@
 # 🖤 dark Life — upgraded life-sim Telegram bot (Python)
-# pip install -U python-telegram-bot==21.6
+# pip install -U "python-telegram-bot[rate-limiter]==21.6"
 # Run:
 #   export DARKLIFE_TOKEN="YOUR_TOKEN"
 #   python dark_life_bot.py
@@ -10,14 +10,23 @@
 # - Crypto market: BTC/ETH/TON/USDT + fiat (RUB/USD/EUR), buy/sell, portfolio
 # - SQLite persistence
 
-import os, json, time, random, sqlite3
-from typing import Dict, Any, Optional, Tuple, List
+import os, time, random, sqlite3, threading, asyncio, logging
+from collections import OrderedDict
+from contextlib import contextmanager, asynccontextmanager
+from functools import lru_cache
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional, Tuple, List, Iterator, AsyncIterator, Callable, TypeVar
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
+from telegram.error import BadRequest
+from telegram.ext import AIORateLimiter, Application, CommandHandler, CallbackQueryHandler, ContextTypes
 
 TOKEN = os.environ.get("DARKLIFE_TOKEN", "")
 DB_PATH = os.environ.get("DARKLIFE_DB", "darklife.db")
+SQL_TRACE = os.environ.get("DARKLIFE_SQL_TRACE") == "1"  # print every statement (dev only)
+
+log = logging.getLogger("darklife")
 
 # ---------- Core caps ----------
 MAX_HEALTH = 100
@@ -30,6 +39,9 @@ ENERGY_DECAY_PER_HOUR = 4
 
 START_MONEY = 5000
 
+# inventory item -> its INTEGER column in users
+INV_COLS = {"еда": "inv_food", "аптечка": "inv_med", "билет": "inv_ticket"}
+
 # ---------- Jobs (level gated) ----------
 # name, min_level, base_pay, xp_gain, energy_cost, hunger_cost
 JOBS = [
@@ -41,7 +53,9 @@ JOBS = [
     ("Сисадмин",     10, 3200, 44, 30, 14),
     ("Разработчик",  15, 4800, 62, 32, 12),
 ]
+JOBS_BY_NAME = {j[0]: j for j in JOBS}
 
+@lru_cache(maxsize=256)
 def xp_needed(level: int) -> int:
     # мягкая прогрессия
     return 60 + level * 45
@@ -55,6 +69,7 @@ BUSINESSES = [
     ("it",      "💻 IT-студия",        160000, 5200, 28000),
     ("club",    "🎶 Ночной клуб",      260000, 8800, 45000),
 ]
+BUSINESSES_BY_ID = {b[0]: b for b in BUSINESSES}
 # income formula: base_daily_income * (1 + 0.35*(level-1))
 
 # ---------- Crypto market ----------
@@ -81,13 +96,90 @@ DEFAULT_PRICES_RUB = {
 CRYPTO_VOL = {"BTC": 0.020, "ETH": 0.028, "TON": 0.055, "USDT": 0.004, "USD": 0.010, "EUR": 0.012, "RUB": 0.0}
 
 # ---------- DB ----------
-def db() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH)
+# one connection for reads and writes (autocommit, explicit BEGIN IMMEDIATE): all SQLite
+# work runs on the single DB thread below, and reads inside a transaction see its writes.
+# The lock is not there for that thread: init_db() runs on the main thread before the bot
+# starts, and scripts may call in from anywhere; uncontended, it costs nothing per click.
+_CONN: Optional[sqlite3.Connection] = None
+_TX_LOCK = threading.Lock()
+_TX = threading.local()  # .active: this thread holds _TX_LOCK inside BEGIN IMMEDIATE
+                         # .on_commit: callbacks to run once that transaction has committed
+
+def _connect() -> sqlite3.Connection:
+    # the connection lives for the whole process, so a bigger statement cache means every
+    # query is parsed once; keep SQL texts constant (no f-strings) so they keep hitting it
+    # as_uri() percent-escapes the path, so '#', '?' and '%' in it stay part of the file name
+    conn = sqlite3.connect(f"{Path(DB_PATH).resolve().as_uri()}?mode=rwc", uri=True, cached_statements=256,
+                           check_same_thread=False, isolation_level=None)
     conn.row_factory = sqlite3.Row
+    if SQL_TRACE:
+        conn.set_trace_callback(print)
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA cache_size=-20000")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")  # 256 MiB: reads come straight from the page cache
     return conn
 
+def db() -> sqlite3.Connection:
+    global _CONN
+    if _CONN is None:
+        _CONN = _connect()
+        # WAL + relaxed fsync: every button press writes, so commits must be cheap
+        _CONN.execute("PRAGMA journal_mode=WAL")
+        _CONN.execute("PRAGMA synchronous=NORMAL")
+        # business incomes mirrored per connection so do_sleep can price payouts in SQL
+        _CONN.execute("CREATE TEMP TABLE biz_cfg(biz_id TEXT PRIMARY KEY, base_inc INTEGER NOT NULL)")
+        _CONN.executemany("INSERT INTO biz_cfg(biz_id, base_inc) VALUES(?,?)",
+                          [(b[0], b[3]) for b in BUSINESSES])
+    return _CONN
+
+def close_db() -> None:
+    global _CONN
+    if _CONN is not None:
+        _CONN.execute("PRAGMA optimize")
+        _CONN.close()
+        _CONN = None
+
+# All SQLite work runs on one dedicated thread (the model aiosqlite uses), so the event
+# loop keeps serving other users while a query or commit waits on disk. One thread also
+# keeps the user cache and the write-behind buffer below free of cross-thread races.
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="darklife-db")
+T = TypeVar("T")
+
+def run_db(fn: Callable[..., T], *args: Any) -> "asyncio.Future[T]":
+    # submitted at call time, not at the first await: the single worker runs jobs in call order
+    return asyncio.get_running_loop().run_in_executor(DB_EXECUTOR, fn, *args)
+
+@contextmanager
+def transaction() -> Iterator[sqlite3.Connection]:
+    if getattr(_TX, "active", False):
+        # nested call joins the outer transaction
+        yield db()
+        return
+    with _TX_LOCK:
+        conn = db()
+        conn.execute("BEGIN IMMEDIATE")
+        _TX.active = True
+        _TX.on_commit = []
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:  # COMMIT itself can fail (SQLITE_BUSY): still roll back
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            _TX.active = False
+            committed, _TX.on_commit = _TX.on_commit, []
+        for fn in committed:
+            fn()
+
+def after_commit(fn: Callable[[], None]) -> None:
+    # must be called inside transaction(); fn is dropped if the transaction rolls back
+    _TX.on_commit.append(fn)
+
 def init_db() -> None:
-    with db() as conn:
+    with transaction() as conn:
         conn.execute("""
         CREATE TABLE IF NOT EXISTS users(
             user_id INTEGER PRIMARY KEY,
@@ -100,7 +192,9 @@ def init_db() -> None:
             job TEXT NOT NULL,
             level INTEGER NOT NULL,
             xp INTEGER NOT NULL,
-            inventory TEXT NOT NULL,
+            inv_food INTEGER NOT NULL DEFAULT 0,
+            inv_med INTEGER NOT NULL DEFAULT 0,
+            inv_ticket INTEGER NOT NULL DEFAULT 0,
             last_seen INTEGER NOT NULL
         );
         """)
@@ -141,42 +235,198 @@ def init_db() -> None:
         meta = conn.execute("SELECT COUNT(*) AS c FROM market_meta").fetchone()["c"]
         if meta == 0:
             conn.execute("INSERT INTO market_meta(key,value) VALUES('last_update', ?)", (int(time.time()),))
-        conn.commit()
+        # covering indexes: per-user business/portfolio reads are served from the index alone
+        conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_ub_cover
+        ON user_businesses(user_id, biz_id, biz_level, last_paid_day)
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_port_cover ON portfolio(user_id, asset, amount)")
+        ensure_columns(conn)
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE name='sqlite_stat1'").fetchone():
+            conn.execute("ANALYZE")  # first run: give the planner stats; PRAGMA optimize keeps them fresh
+
+def ensure_columns(conn: sqlite3.Connection) -> None:
+    # migrate databases created before inventory moved out of the JSON column
+    cols = {r["name"] for r in conn.execute("PRAGMA table_info(users)")}
+    for col in INV_COLS.values():
+        if col not in cols:
+            conn.execute(f"ALTER TABLE users ADD COLUMN {col} INTEGER NOT NULL DEFAULT 0")
+    if "inventory" in cols:
+        conn.execute("""
+        UPDATE users SET
+          inv_food=COALESCE(json_extract(inventory, '$."еда"'), 0),
+          inv_med=COALESCE(json_extract(inventory, '$."аптечка"'), 0),
+          inv_ticket=COALESCE(json_extract(inventory, '$."билет"'), 0)
+        WHERE json_valid(inventory)
+        """)
+        conn.execute("ALTER TABLE users DROP COLUMN inventory")
 
 # ---------- Helpers ----------
 def now_ts() -> int:
     return int(time.time())
 
 def clamp(v: int, lo: int, hi: int) -> int:
-    return max(lo, min(hi, v))
+    # plain comparisons: called many times per click, and max(min()) is two builtin calls
+    return lo if v < lo else hi if v > hi else v
+
+# users column order, as bound by save_user
+USER_COLS = ("user_id", "money", "health", "hunger", "energy", "day", "location", "job",
+             "level", "xp", "inv_food", "inv_med", "inv_ticket", "last_seen")
+# explicit column list so rows zip straight onto USER_COLS (built once: same text every call)
+USER_SELECT_SQL = f"SELECT {', '.join(USER_COLS)} FROM users WHERE user_id=?"
+
+# save_user is write-behind: rows wait here (latest per user wins) and user_flusher()
+# writes them with one executemany per batch instead of one commit per click
+USER_FLUSH_DELAY = 0.005
+USER_FLUSH_BATCH = 64
+USER_FLUSH_RETRY = 1.0
+# user_id -> (row sqlite has now or None if it may have none, row to write)
+_PENDING_USERS: Dict[int, Tuple[Optional[Tuple[Any, ...]], Tuple[Any, ...]]] = {}
+_FLUSH_WAKE: Optional[asyncio.Event] = None
+_FLUSH_TASK: Optional["asyncio.Task[None]"] = None
+_FLUSH_LOOP: Optional[asyncio.AbstractEventLoop] = None  # save_user runs on the DB thread
+
+# last known state of recently active users (LRU) next to the row last handed to SQLite;
+# save_user keeps both current, so a user clicking through menus is served without touching SQLite
+USER_CACHE_SIZE = 10_000
+_USER_CACHE: "OrderedDict[int, Tuple[Dict[str, Any], Tuple[Any, ...]]]" = OrderedDict()
+
+# a click that changed nothing but last_seen is written at most this often (seconds);
+# the cache always has the exact value, the db may lag behind by up to this much
+LAST_SEEN_WRITE_EVERY = 60
+
+def _cache_user(user_id: int, st: Dict[str, Any], row: Tuple[Any, ...]) -> None:
+    _USER_CACHE[user_id] = (st, row)
+    _USER_CACHE.move_to_end(user_id)
+    if len(_USER_CACHE) > USER_CACHE_SIZE:
+        _USER_CACHE.popitem(last=False)
 
 def get_user(user_id: int) -> Optional[Dict[str, Any]]:
-    with db() as conn:
-        r = conn.execute("SELECT * FROM users WHERE user_id=?", (user_id,)).fetchone()
-    return dict(r) if r else None
+    cached = _USER_CACHE.get(user_id)
+    if cached is not None:
+        _USER_CACHE.move_to_end(user_id)
+        return dict(cached[0])  # callers mutate freely; the cache changes only via save_user
+    pending = _PENDING_USERS.get(user_id)
+    if pending is not None:
+        row = pending[1]
+    else:
+        r = db().execute(USER_SELECT_SQL, (user_id,)).fetchone()
+        if not r:
+            return None
+        row = tuple(r)
+    st = dict(zip(USER_COLS, row))
+    _cache_user(user_id, st, row)
+    return dict(st)
 
 def save_user(user_id: int, st: Dict[str, Any]) -> None:
-    with db() as conn:
-        conn.execute("""
-        INSERT INTO users(user_id, money, health, hunger, energy, day, location, job, level, xp, inventory, last_seen)
-        VALUES(?,?,?,?,?,?,?,?,?,?,?,?)
-        ON CONFLICT(user_id) DO UPDATE SET
-          money=excluded.money,
-          health=excluded.health,
-          hunger=excluded.hunger,
-          energy=excluded.energy,
-          day=excluded.day,
-          location=excluded.location,
-          job=excluded.job,
-          level=excluded.level,
-          xp=excluded.xp,
-          inventory=excluded.inventory,
-          last_seen=excluded.last_seen
-        """, (
-            user_id, st["money"], st["health"], st["hunger"], st["energy"], st["day"],
-            st["location"], st["job"], st["level"], st["xp"], st["inventory"], st["last_seen"]
-        ))
-        conn.commit()
+    row = (
+        user_id, st["money"], st["health"], st["hunger"], st["energy"], st["day"],
+        st["location"], st["job"], st["level"], st["xp"],
+        st["inv_food"], st["inv_med"], st["inv_ticket"], st["last_seen"]
+    )
+    cached = _USER_CACHE.get(user_id)
+    prev = None
+    if cached is not None:
+        prev = cached[1]
+        # menu navigation only moves last_seen (row[-1]): keep it in memory, skip the write
+        if row[:-1] == prev[:-1] and row[-1] - prev[-1] < LAST_SEEN_WRITE_EVERY:
+            _cache_user(user_id, st, prev)
+            return
+    # the base of a dirty-column diff must be what sqlite has committed, never a row that
+    # was only handed over: a queued row (maybe from a failed flush) keeps its own base,
+    # which advances in _forget_flushed; with nothing queued the cached row is on disk
+    pending = _PENDING_USERS.get(user_id)
+    base = pending[0] if pending is not None else prev
+    _PENDING_USERS[user_id] = (base, row)
+    _cache_user(user_id, st, row)
+    if _FLUSH_WAKE is None or len(_PENDING_USERS) >= USER_FLUSH_BATCH:
+        # no flusher running (startup, scripts) or the batch is full: write now
+        flush_users()
+    else:
+        _FLUSH_LOOP.call_soon_threadsafe(_FLUSH_WAKE.set)
+
+USER_UPSERT_SQL = """
+INSERT INTO users(user_id, money, health, hunger, energy, day, location, job, level, xp,
+                  inv_food, inv_med, inv_ticket, last_seen)
+VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+ON CONFLICT(user_id) DO UPDATE SET
+  money=excluded.money,
+  health=excluded.health,
+  hunger=excluded.hunger,
+  energy=excluded.energy,
+  day=excluded.day,
+  location=excluded.location,
+  job=excluded.job,
+  level=excluded.level,
+  xp=excluded.xp,
+  inv_food=excluded.inv_food,
+  inv_med=excluded.inv_med,
+  inv_ticket=excluded.inv_ticket,
+  last_seen=excluded.last_seen
+"""
+
+@lru_cache(maxsize=None)
+def _user_update_sql(dirty: Tuple[int, ...]) -> str:
+    sets = ", ".join(f"{USER_COLS[i]}=?" for i in dirty)
+    return f"UPDATE users SET {sets} WHERE user_id=?"
+
+def _restore_user(user_id: int, cached: Optional[Tuple[Dict[str, Any], Tuple[Any, ...]]],
+                  pending: Optional[Tuple[Optional[Tuple[Any, ...]], Tuple[Any, ...]]]) -> None:
+    # undo save_user for a click whose transaction rolled back
+    if cached is None:
+        _USER_CACHE.pop(user_id, None)
+    else:
+        _USER_CACHE[user_id] = cached
+    if pending is None:
+        _PENDING_USERS.pop(user_id, None)
+    else:
+        _PENDING_USERS[user_id] = pending
+
+def flush_users() -> None:
+    if not _PENDING_USERS:
+        return
+    # known rows get an UPDATE of just the columns that changed, batched per column set;
+    # rows that may not exist yet take the full upsert
+    batch = list(_PENDING_USERS.items())
+    upserts = []
+    updates: Dict[Tuple[int, ...], List[Tuple[Any, ...]]] = {}
+    for _, (base, row) in batch:
+        if base is None:
+            upserts.append(row)
+            continue
+        dirty = tuple(i for i in range(1, len(row)) if row[i] != base[i])
+        if dirty:
+            updates.setdefault(dirty, []).append(tuple(row[i] for i in dirty) + (row[0],))
+    with transaction() as conn:
+        for dirty, params in updates.items():
+            conn.executemany(_user_update_sql(dirty), params)
+        if upserts:
+            conn.executemany(USER_UPSERT_SQL, upserts)
+        # rows leave the queue only once they are on disk: a failed flush keeps them for the retry
+        after_commit(lambda: _forget_flushed(batch))
+
+def _forget_flushed(batch: List[Tuple[int, Tuple[Optional[Tuple[Any, ...]], Tuple[Any, ...]]]]) -> None:
+    for user_id, entry in batch:
+        cur = _PENDING_USERS.get(user_id)
+        if cur is entry:
+            del _PENDING_USERS[user_id]
+        elif cur is not None:
+            # a newer save stays queued, but the row it diffs against is now on disk
+            _PENDING_USERS[user_id] = (entry[1], cur[1])
+
+async def user_flusher() -> None:
+    assert _FLUSH_WAKE is not None
+    while True:
+        await _FLUSH_WAKE.wait()
+        await asyncio.sleep(USER_FLUSH_DELAY)  # let concurrent clicks join the batch
+        _FLUSH_WAKE.clear()
+        try:
+            await run_db(flush_users)
+        except Exception:
+            # the rows are still queued; keep the task alive and try again shortly
+            log.exception("user flush failed, retrying in %ss", USER_FLUSH_RETRY)
+            await asyncio.sleep(USER_FLUSH_RETRY)
+            _FLUSH_WAKE.set()
 
 def default_state() -> Dict[str, Any]:
     return {
@@ -189,38 +439,32 @@ def default_state() -> Dict[str, Any]:
         "job": "Безработный",
         "level": 1,
         "xp": 0,
-        "inventory": json.dumps({"еда": 0, "аптечка": 0, "билет": 0}, ensure_ascii=False),
+        "inv_food": 0,
+        "inv_med": 0,
+        "inv_ticket": 0,
         "last_seen": now_ts(),
     }
 
-def inv_get(st: Dict[str, Any]) -> Dict[str, int]:
-    try:
-        return json.loads(st["inventory"])
-    except Exception:
-        return {"еда": 0, "аптечка": 0, "билет": 0}
-
-def inv_set(st: Dict[str, Any], inv: Dict[str, int]) -> None:
-    st["inventory"] = json.dumps(inv, ensure_ascii=False)
-
 def apply_decay(st: Dict[str, Any]) -> str:
-    last = int(st.get("last_seen", now_ts()))
-    dt = max(0, now_ts() - last)
-    hours = dt / 3600.0
-    if hours < 0.2:
-        st["last_seen"] = now_ts()
+    last = int(st["last_seen"])  # every state carries all columns (get_user/default_state)
+    now = now_ts()  # read the clock once for the whole call
+    dt = max(0, now - last)
+    if dt < 720:  # less than 0.2h: nothing decays yet
+        st["last_seen"] = now
         return ""
-    hunger_loss = int(hours * HUNGER_DECAY_PER_HOUR)
-    energy_loss = int(hours * ENERGY_DECAY_PER_HOUR)
+    # per-hour rates applied to whole seconds in integer math (== int(hours * rate), no floats)
+    hunger_loss = dt * HUNGER_DECAY_PER_HOUR // 3600
+    energy_loss = dt * ENERGY_DECAY_PER_HOUR // 3600
     st["hunger"] = clamp(st["hunger"] - hunger_loss, 0, MAX_HUNGER)
     st["energy"] = clamp(st["energy"] - energy_loss, 0, MAX_ENERGY)
 
     hp_loss = 0
-    if st["hunger"] <= 10: hp_loss += int(hours * 3)
-    if st["energy"] <= 10: hp_loss += int(hours * 2)
+    if st["hunger"] <= 10: hp_loss += dt * 3 // 3600
+    if st["energy"] <= 10: hp_loss += dt * 2 // 3600
     st["health"] = clamp(st["health"] - hp_loss, 0, MAX_HEALTH)
 
-    st["last_seen"] = now_ts()
-    note = f"⏳ Прошло ~{hours:.1f}ч: голод -{hunger_loss}, энергия -{energy_loss}."
+    st["last_seen"] = now
+    note = f"⏳ Прошло ~{dt / 3600:.1f}ч: голод -{hunger_loss}, энергия -{energy_loss}."
     if st["health"] <= 0:
         note += "\n💀 Ты умер(ла). Нажми /start."
     return note
@@ -244,14 +488,37 @@ def maybe_level_up(st: Dict[str, Any]) -> str:
     return msg
 
 # ---------- Market ----------
+# Prices only change in market_update_if_needed (at most every 5 minutes), so keep the
+# market in process: readers get dict lookups and the 5-minute check needs no SQL.
+_PRICE_CACHE: Dict[str, float] = {}
+_MARKET_TS = 0  # market_meta.last_update behind _PRICE_CACHE
+
+def _read_market(conn: sqlite3.Connection) -> Tuple[Dict[str, float], int]:
+    last = conn.execute("SELECT value FROM market_meta WHERE key='last_update'").fetchone()
+    prices = {r["key"]: float(r["value"]) for r in conn.execute("SELECT key,value FROM market")}
+    return prices, int(last["value"]) if last else 0
+
+def _publish_market(prices: Dict[str, float], ts: int) -> None:
+    global _MARKET_TS
+    _PRICE_CACHE.clear()
+    _PRICE_CACHE.update(prices)
+    _MARKET_TS = ts
+
+def _market() -> Dict[str, float]:
+    if not _PRICE_CACHE:
+        _publish_market(*_read_market(db()))
+    return _PRICE_CACHE
+
 def market_update_if_needed() -> None:
-    with db() as conn:
-        last = conn.execute("SELECT value FROM market_meta WHERE key='last_update'").fetchone()
-        last_ts = int(last["value"]) if last else 0
-        if now_ts() - last_ts < 300:  # обновляем не чаще чем раз в 5 минут
+    _market()
+    if now_ts() - _MARKET_TS < 300:  # обновляем не чаще чем раз в 5 минут
+        return
+    with transaction() as conn:
+        prices, ts = _read_market(conn)  # authoritative re-read inside BEGIN IMMEDIATE
+        if now_ts() - ts < 300:
+            after_commit(lambda: _publish_market(prices, ts))
             return
 
-        prices = {r["key"]: float(r["value"]) for r in conn.execute("SELECT key,value FROM market")}
         # random walk
         for sym, _, _ in ASSETS:
             if sym == "RUB":
@@ -266,116 +533,179 @@ def market_update_if_needed() -> None:
             else:
                 prices[sym] = max(0.0001, prices.get(sym, DEFAULT_PRICES_RUB.get(sym, 1.0)) * (1 + drift))
 
-        for k, v in prices.items():
-            conn.execute("UPDATE market SET value=? WHERE key=?", (float(v), k))
-        conn.execute("UPDATE market_meta SET value=? WHERE key='last_update'", (now_ts(),))
-        conn.commit()
+        ts = now_ts()
+        conn.executemany("UPDATE market SET value=? WHERE key=?", [(float(v), k) for k, v in prices.items()])
+        conn.execute("UPDATE market_meta SET value=? WHERE key='last_update'", (ts,))
+        # the cache follows the db only once this commits: inside a click this joins the
+        # click's transaction, which can still roll back
+        after_commit(lambda: _publish_market(prices, ts))
 
 def get_price(sym: str) -> float:
-    with db() as conn:
-        r = conn.execute("SELECT value FROM market WHERE key=?", (sym,)).fetchone()
-    return float(r["value"]) if r else float(DEFAULT_PRICES_RUB.get(sym, 1.0))
+    p = _market().get(sym)
+    return p if p is not None else float(DEFAULT_PRICES_RUB.get(sym, 1.0))
+
+def get_prices() -> Dict[str, float]:
+    # the whole market, with the same fallback as get_price()
+    prices = dict(DEFAULT_PRICES_RUB)
+    prices.update(_market())
+    return prices
 
 def portfolio_get(user_id: int) -> Dict[str, float]:
-    with db() as conn:
-        rows = conn.execute("SELECT asset, amount FROM portfolio WHERE user_id=?", (user_id,)).fetchall()
+    rows = db().execute("SELECT asset, amount FROM portfolio WHERE user_id=?", (user_id,)).fetchall()
     d = {r["asset"]: float(r["amount"]) for r in rows}
     if "RUB" not in d:
         d["RUB"] = 0.0
     return d
 
+def portfolio_valued(user_id: int) -> List[Tuple[str, float, float]]:
+    # (asset, amount, price in RUB) for every holding, priced by one JOIN
+    rows = db().execute("""
+    SELECT p.asset, p.amount, m.value
+    FROM portfolio p LEFT JOIN market m ON m.key = p.asset
+    WHERE p.user_id=?
+    ORDER BY p.asset
+    """, (user_id,)).fetchall()
+    return [
+        (a, float(amt), float(v) if v is not None else float(DEFAULT_PRICES_RUB.get(a, 1.0)))
+        for a, amt, v in rows
+    ]
+
 def portfolio_set(user_id: int, asset: str, amount: float) -> None:
-    with db() as conn:
+    with transaction() as conn:
         conn.execute("""
         INSERT INTO portfolio(user_id, asset, amount)
         VALUES(?,?,?)
         ON CONFLICT(user_id, asset) DO UPDATE SET amount=excluded.amount
         """, (user_id, asset, float(amount)))
-        conn.commit()
 
 # ---------- Businesses ----------
-def user_biz_list(user_id: int) -> List[sqlite3.Row]:
-    with db() as conn:
-        return conn.execute(
-            "SELECT biz_id, biz_level, last_paid_day FROM user_businesses WHERE user_id=?",
-            (user_id,)
-        ).fetchall()
-
-def user_biz_get(user_id: int, biz_id: str) -> Optional[sqlite3.Row]:
-    with db() as conn:
-        return conn.execute(
-            "SELECT biz_id, biz_level, last_paid_day FROM user_businesses WHERE user_id=? AND biz_id=?",
-            (user_id, biz_id)
-        ).fetchone()
+def user_biz_levels(user_id: int) -> Dict[str, int]:
+    # One read per click: the ownership check, the write and the keyboard all share this dict.
+    return dict(db().execute(
+        "SELECT biz_id, biz_level FROM user_businesses WHERE user_id=?",
+        (user_id,)
+    ).fetchall())
+
+USER_BIZ_UPSERT_SQL = """
+INSERT INTO user_businesses(user_id, biz_id, biz_level, last_paid_day)
+VALUES(?,?,?,?)
+ON CONFLICT(user_id, biz_id) DO UPDATE SET
+  biz_level=excluded.biz_level,
+  last_paid_day=excluded.last_paid_day
+"""
+
+def user_biz_set_level(user_id: int, biz_id: str, biz_level: int) -> None:
+    with transaction() as conn:
+        conn.execute(
+            "UPDATE user_businesses SET biz_level=? WHERE user_id=? AND biz_id=?",
+            (biz_level, user_id, biz_id)
+        )
 
 def user_biz_upsert(user_id: int, biz_id: str, biz_level: int, last_paid_day: int) -> None:
-    with db() as conn:
-        conn.execute("""
-        INSERT INTO user_businesses(user_id, biz_id, biz_level, last_paid_day)
-        VALUES(?,?,?,?)
-        ON CONFLICT(user_id, biz_id) DO UPDATE SET
-          biz_level=excluded.biz_level,
-          last_paid_day=excluded.last_paid_day
-        """, (user_id, biz_id, int(biz_level), int(last_paid_day)))
-        conn.commit()
+    with transaction() as conn:
+        conn.execute(USER_BIZ_UPSERT_SQL, (user_id, biz_id, int(biz_level), int(last_paid_day)))
+
+def user_biz_collect(user_id: int, day: int) -> int:
+    # pay every business not yet paid for `day`; same formula as biz_income(), in SQL
+    with transaction() as conn:
+        total = conn.execute("""
+        SELECT COALESCE(SUM(CAST(c.base_inc * (1 + 0.35 * MAX(0, b.biz_level - 1)) AS INTEGER)), 0)
+        FROM user_businesses b JOIN biz_cfg c USING(biz_id)
+        WHERE b.user_id=? AND b.last_paid_day<?
+        """, (user_id, day)).fetchone()[0]
+        conn.execute(
+            "UPDATE user_businesses SET last_paid_day=? WHERE user_id=? AND last_paid_day<?",
+            (day, user_id, day)
+        )
+    return int(total)
+
+UNKNOWN_BIZ = ("❓", 10**9, 0, 10**9)
 
 def biz_info(biz_id: str) -> Tuple[str, int, int, int]:
-    for _id, name, buy, inc, upc in BUSINESSES:
-        if _id == biz_id:
-            return name, buy, inc, upc
-    return ("❓", 10**9, 0, 10**9)
+    b = BUSINESSES_BY_ID.get(biz_id)
+    return b[1:] if b else UNKNOWN_BIZ
 
+# pure functions of small ints, hit on every business menu render: memoize
+@lru_cache(maxsize=256)
 def biz_income(base_income: int, lvl: int) -> int:
     return int(base_income * (1 + 0.35 * max(0, lvl - 1)))
 
+@lru_cache(maxsize=256)
 def biz_upgrade_cost(base_cost: int, lvl: int) -> int:
     # cost grows
     return int(base_cost * (1.55 ** max(0, lvl - 1)))
 
 # ---------- UI Keyboards ----------
+# static keyboards are built once at import; markups are immutable and safe to share
+KB_MAIN = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📊 Статус", callback_data="status"),
+     InlineKeyboardButton("🎒 Инвентарь", callback_data="inv")],
+    [InlineKeyboardButton("💼 Работа", callback_data="work_menu"),
+     InlineKeyboardButton("🍜 Еда", callback_data="eat_menu")],
+    [InlineKeyboardButton("🏢 Бизнес", callback_data="biz_menu"),
+     InlineKeyboardButton("🪙 Крипта", callback_data="crypto_menu")],
+    [InlineKeyboardButton("😴 Сон (новый день)", callback_data="sleep"),
+     InlineKeyboardButton("🎲 Событие", callback_data="event")],
+])
+
 def kb_main() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("📊 Статус", callback_data="status"),
-         InlineKeyboardButton("🎒 Инвентарь", callback_data="inv")],
-        [InlineKeyboardButton("💼 Работа", callback_data="work_menu"),
-         InlineKeyboardButton("🍜 Еда", callback_data="eat_menu")],
-        [InlineKeyboardButton("🏢 Бизнес", callback_data="biz_menu"),
-         InlineKeyboardButton("🪙 Крипта", callback_data="crypto_menu")],
-        [InlineKeyboardButton("😴 Сон (новый день)", callback_data="sleep"),
-         InlineKeyboardButton("🎲 Событие", callback_data="event")],
-    ])
+    return KB_MAIN
+
+KB_BACK = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back")]])
 
 def kb_back() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back")]])
+    return KB_BACK
+
+KB_EAT = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🎒 Съесть из инвентаря", callback_data="eat_inv"),
+     InlineKeyboardButton("🍽️ Кафе (450₽)", callback_data="eat_cafe")],
+    [InlineKeyboardButton("⬅️ Назад", callback_data="back")]
+])
 
 def kb_eat() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("🎒 Съесть из инвентаря", callback_data="eat_inv"),
-         InlineKeyboardButton("🍽️ Кафе (450₽)", callback_data="eat_cafe")],
-        [InlineKeyboardButton("⬅️ Назад", callback_data="back")]
-    ])
+    return KB_EAT
 
-def kb_work(st: Dict[str, Any]) -> InlineKeyboardMarkup:
-    lvl = st["level"]
-    rows = []
-    for name, min_lvl, _, _, _, _ in JOBS:
-        if lvl >= min_lvl:
-            rows.append([InlineKeyboardButton(f"✅ {name} (с {min_lvl} lvl)", callback_data=f"job_set|{name}")])
-        else:
-            rows.append([InlineKeyboardButton(f"🔒 {name} (нужен {min_lvl} lvl)", callback_data="noop")])
+MAX_JOB_LVL = max(j[1] for j in JOBS)
+
+# every job button in both variants, made once; a keyboard just picks one per row
+_JOB_BUTTON_UNLOCKED = {
+    name: InlineKeyboardButton(f"✅ {name} (с {min_lvl} lvl)", callback_data=f"job_set|{name}")
+    for name, min_lvl, _, _, _, _ in JOBS
+}
+_JOB_BUTTON_LOCKED = {
+    name: InlineKeyboardButton(f"🔒 {name} (нужен {min_lvl} lvl)", callback_data="noop")
+    for name, min_lvl, _, _, _, _ in JOBS
+}
+
+def _build_kb_work(lvl: int) -> InlineKeyboardMarkup:
+    rows = [
+        [_JOB_BUTTON_UNLOCKED[name] if lvl >= min_lvl else _JOB_BUTTON_LOCKED[name]]
+        for name, min_lvl, _, _, _, _ in JOBS
+    ]
     rows.append([InlineKeyboardButton("🔨 Работать сейчас", callback_data="work_do")])
     rows.append([InlineKeyboardButton("⬅️ Назад", callback_data="back")])
     return InlineKeyboardMarkup(rows)
 
+# past the last unlock every level sees the same keyboard, so these are all there is
+KB_WORK = {lvl: _build_kb_work(lvl) for lvl in range(1, MAX_JOB_LVL + 1)}
+
+def kb_work(st: Dict[str, Any]) -> InlineKeyboardMarkup:
+    return KB_WORK[min(st["level"], MAX_JOB_LVL)]
+
+KB_BIZ_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🛒 Купить бизнес", callback_data="biz_shop"),
+     InlineKeyboardButton("📈 Мои бизнесы", callback_data="biz_my")],
+    [InlineKeyboardButton("⬅️ Назад", callback_data="back")]
+])
+
 def kb_biz_menu() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("🛒 Купить бизнес", callback_data="biz_shop"),
-         InlineKeyboardButton("📈 Мои бизнесы", callback_data="biz_my")],
-        [InlineKeyboardButton("⬅️ Назад", callback_data="back")]
-    ])
-
-def kb_biz_shop(user_id: int) -> InlineKeyboardMarkup:
-    owned = {r["biz_id"] for r in user_biz_list(user_id)}
+    return KB_BIZ_MENU
+
+def kb_biz_shop(owned: Dict[str, int]) -> InlineKeyboardMarkup:
+    return _kb_biz_shop(frozenset(owned))
+
+@lru_cache(maxsize=64)
+def _kb_biz_shop(owned: "frozenset[str]") -> InlineKeyboardMarkup:
     rows = []
     for biz_id, name, buy_price, base_inc, _ in BUSINESSES:
         if biz_id in owned:
@@ -385,16 +715,17 @@ def kb_biz_shop(user_id: int) -> InlineKeyboardMarkup:
     rows.append([InlineKeyboardButton("⬅️ Назад", callback_data="biz_menu")])
     return InlineKeyboardMarkup(rows)
 
-def kb_biz_my(user_id: int) -> InlineKeyboardMarkup:
+def kb_biz_my(owned: Dict[str, int]) -> InlineKeyboardMarkup:
+    return _kb_biz_my(tuple(owned.items()))
+
+@lru_cache(maxsize=1024)
+def _kb_biz_my(owned: Tuple[Tuple[str, int], ...]) -> InlineKeyboardMarkup:
     rows = []
-    owned = user_biz_list(user_id)
     if not owned:
         rows.append([InlineKeyboardButton("Пусто 😅", callback_data="noop")])
     else:
-        for r in owned:
-            biz_id = r["biz_id"]
+        for biz_id, lvl in owned:
             name, _, base_inc, upc = biz_info(biz_id)
-            lvl = int(r["biz_level"])
             inc = biz_income(base_inc, lvl)
             cost = biz_upgrade_cost(upc, lvl+1)
             rows.append([InlineKeyboardButton(f"{name} • lvl {lvl} • {inc}₽/день", callback_data=f"biz_view|{biz_id}")])
@@ -402,15 +733,19 @@ def kb_biz_my(user_id: int) -> InlineKeyboardMarkup:
     rows.append([InlineKeyboardButton("⬅️ Назад", callback_data="biz_menu")])
     return InlineKeyboardMarkup(rows)
 
+KB_CRYPTO_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📉 Рынок", callback_data="crypto_market"),
+     InlineKeyboardButton("💼 Портфель", callback_data="crypto_port")],
+    [InlineKeyboardButton("🟢 Купить", callback_data="crypto_buy_menu"),
+     InlineKeyboardButton("🔴 Продать", callback_data="crypto_sell_menu")],
+    [InlineKeyboardButton("⬅️ Назад", callback_data="back")]
+])
+
 def kb_crypto_menu() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("📉 Рынок", callback_data="crypto_market"),
-         InlineKeyboardButton("💼 Портфель", callback_data="crypto_port")],
-        [InlineKeyboardButton("🟢 Купить", callback_data="crypto_buy_menu"),
-         InlineKeyboardButton("🔴 Продать", callback_data="crypto_sell_menu")],
-        [InlineKeyboardButton("⬅️ Назад", callback_data="back")]
-    ])
+    return KB_CRYPTO_MENU
 
+# built once per variant; markups are immutable so the cached object is shared
+@lru_cache(maxsize=None)  # action is only ever "buy" or "sell"
 def kb_crypto_pick(action: str) -> InlineKeyboardMarkup:
     # action = buy or sell
     rows = []
@@ -421,6 +756,7 @@ def kb_crypto_pick(action: str) -> InlineKeyboardMarkup:
     rows.append([InlineKeyboardButton("⬅️ Назад", callback_data="crypto_menu")])
     return InlineKeyboardMarkup(rows)
 
+@lru_cache(maxsize=64)  # sym comes from callback data, so keep the cache bounded
 def kb_crypto_amount(action: str, sym: str) -> InlineKeyboardMarkup:
     # quick amounts in RUB for buy, units for sell (simplify)
     if action == "buy":
@@ -440,11 +776,9 @@ def kb_crypto_amount(action: str, sym: str) -> InlineKeyboardMarkup:
 
 # ---------- Actions ----------
 def do_eat_inv(st: Dict[str, Any]) -> str:
-    inv = inv_get(st)
-    if inv.get("еда", 0) <= 0:
+    if st["inv_food"] <= 0:
         return "🎒 Нет еды. Купи еду позже (можем добавить магазин — скажи)."
-    inv["еда"] -= 1
-    inv_set(st, inv)
+    st["inv_food"] -= 1
     st["hunger"] = clamp(st["hunger"] + 35, 0, MAX_HUNGER)
     st["energy"] = clamp(st["energy"] + 5, 0, MAX_ENERGY)
     return "🍜 Поел(а) из инвентаря: сытость +35, энергия +5."
@@ -464,7 +798,7 @@ def do_work(st: Dict[str, Any]) -> str:
     if st["energy"] < 20 or st["hunger"] < 15:
         return "😵 Слишком голоден/уставший. Поешь или поспи."
 
-    job = next((j for j in JOBS if j[0] == st["job"]), None)
+    job = JOBS_BY_NAME.get(st["job"])
     if not job:
         st["job"] = "Безработный"
         return "🤔 Работа слетела. Выбери снова."
@@ -493,92 +827,91 @@ def do_sleep(st: Dict[str, Any], user_id: int) -> str:
         st["health"] = clamp(st["health"] + 6, 0, MAX_HEALTH)
 
     # businesses pay per day
-    total_income = 0
-    owned = user_biz_list(user_id)
-    for r in owned:
-        biz_id = r["biz_id"]
-        lvl = int(r["biz_level"])
-        last_paid = int(r["last_paid_day"])
-        if last_paid >= st["day"]:
-            continue
-        name, _, base_inc, _ = biz_info(biz_id)
-        inc = biz_income(base_inc, lvl)
-        total_income += inc
-        user_biz_upsert(user_id, biz_id, lvl, st["day"])
+    total_income = user_biz_collect(user_id, st["day"])
 
     if total_income > 0:
         st["money"] += total_income
         return f"😴 Новый день 🌅\n🏢 Бизнесы принесли: +{total_income}₽"
     return "😴 Новый день 🌅"
 
+# title, delta
+EVENTS = [
+    ("🎁 Нашел кошелек", {"money": +600}),
+    ("🚓 Штраф", {"money": -200}),
+    ("🤕 Упал", {"health": -10}),
+    ("☕ Угостили кофе", {"energy": +10}),
+    ("🧑‍🎤 Подработка", {"money": +900, "energy": -10}),
+]
+# upper bound for every stat an event may touch (money only floors at 0)
+STAT_CAPS = {"health": MAX_HEALTH, "hunger": MAX_HUNGER, "energy": MAX_ENERGY}
+
 def do_event(st: Dict[str, Any]) -> str:
-    events = [
-        ("🎁 Нашел кошелек", {"money": +600}),
-        ("🚓 Штраф", {"money": -200}),
-        ("🤕 Упал", {"health": -10}),
-        ("☕ Угостили кофе", {"energy": +10}),
-        ("🧑‍🎤 Подработка", {"money": +900, "energy": -10}),
-    ]
-    title, delta = random.choice(events)
+    title, delta = random.choice(EVENTS)
     for k, v in delta.items():
         if k == "money":
             st["money"] = max(0, st["money"] + v)
-        elif k == "health":
-            st["health"] = clamp(st["health"] + v, 0, MAX_HEALTH)
-        elif k == "energy":
-            st["energy"] = clamp(st["energy"] + v, 0, MAX_ENERGY)
+        else:
+            st[k] = clamp(st[k] + v, 0, STAT_CAPS[k])
     return f"🎲 Событие: {title}"
 
-def biz_buy(st: Dict[str, Any], user_id: int, biz_id: str) -> str:
+def biz_buy(st: Dict[str, Any], user_id: int, owned: Dict[str, int], biz_id: str) -> str:
     name, buy_price, _, _ = biz_info(biz_id)
-    if user_biz_get(user_id, biz_id):
+    if biz_id in owned:
         return f"✅ {name} уже куплен."
     if st["money"] < buy_price:
         return f"❌ Не хватает денег на {name}. Нужно {buy_price}₽."
     st["money"] -= buy_price
     user_biz_upsert(user_id, biz_id, 1, st["day"])  # pay starts next day
+    owned[biz_id] = 1
     return f"🏢 Куплен бизнес: {name} ✅"
 
-def biz_upgrade(st: Dict[str, Any], user_id: int, biz_id: str) -> str:
-    r = user_biz_get(user_id, biz_id)
+def biz_upgrade(st: Dict[str, Any], user_id: int, owned: Dict[str, int], biz_id: str) -> str:
+    lvl = owned.get(biz_id)
     name, _, base_inc, base_up = biz_info(biz_id)
-    if not r:
+    if lvl is None:
         return "❌ У тебя нет этого бизнеса."
-    lvl = int(r["biz_level"])
     cost = biz_upgrade_cost(base_up, lvl + 1)
     if st["money"] < cost:
         return f"❌ Апгрейд стоит {cost}₽. Не хватает денег."
     st["money"] -= cost
     new_lvl = lvl + 1
-    user_biz_upsert(user_id, biz_id, new_lvl, int(r["last_paid_day"]))
+    user_biz_set_level(user_id, biz_id, new_lvl)
+    owned[biz_id] = new_lvl
     inc = biz_income(base_inc, new_lvl)
     return f"⬆️ {name} улучшен до lvl {new_lvl}. Теперь приносит ~{inc}₽/день."
 
+# rendered market screen and the _MARKET_TS it was rendered for; prices only move
+# every 5 minutes, so every other click gets the string as is
+_MARKET_TEXT: Tuple[int, str] = (-1, "")
+
 def crypto_market_text() -> str:
+    global _MARKET_TEXT
     market_update_if_needed()
+    if _MARKET_TEXT[0] == _MARKET_TS:
+        return _MARKET_TEXT[1]
+    prices = get_prices()
     lines = ["📉 *Рынок (в ₽)*"]
     for sym, icon, _ in ASSETS:
         if sym == "RUB": 
             continue
-        p = get_price(sym)
+        p = prices[sym]
         lines.append(f"{icon} {sym}: {p:,.2f} ₽".replace(",", " "))
-    return "\n".join(lines)
+    _MARKET_TEXT = (_MARKET_TS, "\n".join(lines))
+    return _MARKET_TEXT[1]
 
 def crypto_port_text(user_id: int) -> str:
     market_update_if_needed()
-    port = portfolio_get(user_id)
     # show only non-zero
-    items = [(a, amt) for a, amt in port.items() if abs(amt) > 1e-9]
+    items = [row for row in portfolio_valued(user_id) if abs(row[1]) > 1e-9]
     if not items:
         return "💼 Портфель пуст."
     total_rub = 0.0
     lines = ["💼 *Портфель*"]
-    for asset, amt in items:
+    for asset, amt, p in items:
         if asset == "RUB":
             total_rub += amt
             lines.append(f"₽ RUB: {amt:,.2f}".replace(",", " "))
         else:
-            p = get_price(asset)
             val = amt * p
             total_rub += val
             lines.append(f"{asset}: {amt:.6f} (~{val:,.2f} ₽)".replace(",", " "))
@@ -620,7 +953,7 @@ def crypto_sell(st: Dict[str, Any], user_id: int, sym: str, fraction: float) ->
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     st = default_state()
-    save_user(user_id, st)
+    await run_db(save_user, user_id, st)
     await update.message.reply_text(
         "🖤 *dark Life*\n\nТы приехал(а) на вокзал. У тебя *5000₽*.\nЖиви как в реальной жизни.\n\n"
         + render(st) + "\nВыбирай действие 👇",
@@ -631,138 +964,263 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text("/start — начать заново\n/help — помощь")
 
-async def on_btn(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    q = update.callback_query
-    await q.answer()
+# ---------- Buttons ----------
+# callback_data is "action" or "action|arg"; each handler returns (message, keyboard)
+Reply = Tuple[str, InlineKeyboardMarkup]
 
-    user_id = q.from_user.id
-    st = get_user(user_id) or default_state()
+def btn_noop(st: Dict[str, Any], user_id: int, arg: str) -> Reply:
+    return "🤐", kb_main()
 
-    note = apply_decay(st)
-    if st["health"] <= 0:
-        save_user(user_id, st)
-        await q.edit_message_text("💀 Ты умер(ла). Нажми /start.")
-        return
+def btn_back(st: Dict[str, Any], user_id: int, arg: str) -> Reply:
+    return "🏁 Главное меню", kb_main()
 
-    data = q.data or ""
-    msg = ""
-    kb = kb_main()
-
-    if data == "noop":
-        msg = "🤐"
-    elif data == "back":
-        msg = "🏁 Главное меню"
-    elif data == "status":
-        msg = "📊 *Статус*\n\n" + render(st)
-    elif data == "inv":
-        inv = inv_get(st)
-        msg = "🎒 *Инвентарь*\n" + "\n".join([f"• {k}: {v}" for k, v in inv.items()])
-    elif data == "eat_menu":
-        msg = "🍜 *Еда*"
-        kb = kb_eat()
-    elif data == "eat_inv":
-        msg = do_eat_inv(st)
-    elif data == "eat_cafe":
-        msg = do_eat_cafe(st)
-
-    elif data == "work_menu":
-        msg = "💼 *Работа*\nВыбери работу по уровню, затем жми «Работать сейчас»."
-        kb = kb_work(st)
-    elif data.startswith("job_set|"):
-        st["job"] = data.split("|", 1)[1]
-        msg = f"✅ Выбрана работа: *{st['job']}*"
-        kb = kb_work(st)
-    elif data == "work_do":
-        msg = do_work(st)
-        kb = kb_work(st)
-
-    elif data == "biz_menu":
-        msg = "🏢 *Бизнес*"
-        kb = kb_biz_menu()
-    elif data == "biz_shop":
-        msg = "🛒 *Купить бизнес*"
-        kb = kb_biz_shop(user_id)
-    elif data == "biz_my":
-        msg = "📈 *Мои бизнесы*"
-        kb = kb_biz_my(user_id)
-    elif data.startswith("biz_buy|"):
-        biz_id = data.split("|", 1)[1]
-        msg = biz_buy(st, user_id, biz_id)
-        kb = kb_biz_shop(user_id)
-    elif data.startswith("biz_up|"):
-        biz_id = data.split("|", 1)[1]
-        msg = biz_upgrade(st, user_id, biz_id)
-        kb = kb_biz_my(user_id)
-    elif data.startswith("biz_view|"):
-        biz_id = data.split("|", 1)[1]
-        name, _, base_inc, base_up = biz_info(biz_id)
-        r = user_biz_get(user_id, biz_id)
-        if not r:
-            msg = "❌ Нет такого бизнеса."
-        else:
-            lvl = int(r["biz_level"])
-            inc = biz_income(base_inc, lvl)
-            cost = biz_upgrade_cost(base_up, lvl + 1)
-            msg = f"{name}\n📈 Уровень: {lvl}\n💵 Доход: ~{inc}₽/день\n⬆️ Апгрейд: {cost}₽"
-        kb = kb_biz_my(user_id)
-
-    elif data == "crypto_menu":
-        msg = "🪙 *Крипта*"
-        kb = kb_crypto_menu()
-    elif data == "crypto_market":
-        msg = crypto_market_text()
-        kb = kb_crypto_menu()
-    elif data == "crypto_port":
-        msg = crypto_port_text(user_id)
-        kb = kb_crypto_menu()
-    elif data == "crypto_buy_menu":
-        msg = "🟢 *Купить* — выбери актив"
-        kb = kb_crypto_pick("buy")
-    elif data == "crypto_sell_menu":
-        msg = "🔴 *Продать* — выбери актив"
-        kb = kb_crypto_pick("sell")
-    elif data.startswith("crypto_buy|"):
-        sym = data.split("|", 1)[1]
-        msg = f"🟢 Купить {sym}: выбери сумму"
-        kb = kb_crypto_amount("buy", sym)
-    elif data.startswith("crypto_sell|"):
-        sym = data.split("|", 1)[1]
-        msg = f"🔴 Продать {sym}: выбери долю"
-        kb = kb_crypto_amount("sell", sym)
-    elif data.startswith("crypto_buy_do|"):
-        _, sym, amt = data.split("|")
-        msg = crypto_buy(st, user_id, sym, int(float(amt)))
-        kb = kb_crypto_menu()
-    elif data.startswith("crypto_sell_do|"):
-        _, sym, frac = data.split("|")
-        msg = crypto_sell(st, user_id, sym, float(frac))
-        kb = kb_crypto_menu()
-
-    elif data == "sleep":
-        msg = do_sleep(st, user_id)
-    elif data == "event":
-        msg = do_event(st)
+def btn_status(st: Dict[str, Any], user_id: int, arg: str) -> Reply:
+    return "📊 *Статус*\n\n" + render(st), kb_main()
 
+def btn_inv(st: Dict[str, Any], user_id: int, arg: str) -> Reply:
+    return "🎒 *Инвентарь*\n" + "\n".join([f"• {item}: {st[col]}" for item, col in INV_COLS.items()]), kb_main()
+
+def btn_eat_menu(st: Dict[str, Any], user_id: int, arg: str) -> Reply:
+    return "🍜 *Еда*", kb_eat()
+
+def btn_eat_inv(st: Dict[str, Any], user_id: int, arg: str) -> Reply:
+    return do_eat_inv(st), kb_main()
+
+def btn_eat_cafe(st: Dict[str, Any], user_id: int, arg: str) -> Reply:
+    return do_eat_cafe(st), kb_main()
+
+def btn_work_menu(st: Dict[str, Any], user_id: int, arg: str) -> Reply:
+    return "💼 *Работа*\nВыбери работу по уровню, затем жми «Работать сейчас».", kb_work(st)
+
+def btn_job_set(st: Dict[str, Any], user_id: int, arg: str) -> Reply:
+    st["job"] = arg
+    return f"✅ Выбрана работа: *{st['job']}*", kb_work(st)
+
+def btn_work_do(st: Dict[str, Any], user_id: int, arg: str) -> Reply:
+    msg = do_work(st)
+    return msg, kb_work(st)
+
+def btn_biz_menu(st: Dict[str, Any], user_id: int, arg: str) -> Reply:
+    return "🏢 *Бизнес*", kb_biz_menu()
+
+def btn_biz_shop(st: Dict[str, Any], user_id: int, arg: str) -> Reply:
+    return "🛒 *Купить бизнес*", kb_biz_shop(user_biz_levels(user_id))
+
+def btn_biz_my(st: Dict[str, Any], user_id: int, arg: str) -> Reply:
+    return "📈 *Мои бизнесы*", kb_biz_my(user_biz_levels(user_id))
+
+def btn_biz_buy(st: Dict[str, Any], user_id: int, arg: str) -> Reply:
+    owned = user_biz_levels(user_id)
+    msg = biz_buy(st, user_id, owned, arg)
+    return msg, kb_biz_shop(owned)
+
+def btn_biz_up(st: Dict[str, Any], user_id: int, arg: str) -> Reply:
+    owned = user_biz_levels(user_id)
+    msg = biz_upgrade(st, user_id, owned, arg)
+    return msg, kb_biz_my(owned)
+
+def btn_biz_view(st: Dict[str, Any], user_id: int, arg: str) -> Reply:
+    name, _, base_inc, base_up = biz_info(arg)
+    owned = user_biz_levels(user_id)
+    lvl = owned.get(arg)
+    if lvl is None:
+        msg = "❌ Нет такого бизнеса."
     else:
-        msg = "🤔 Не понял кнопку."
+        inc = biz_income(base_inc, lvl)
+        cost = biz_upgrade_cost(base_up, lvl + 1)
+        msg = f"{name}\n📈 Уровень: {lvl}\n💵 Доход: ~{inc}₽/день\n⬆️ Апгрейд: {cost}₽"
+    return msg, kb_biz_my(owned)
+
+def btn_crypto_menu(st: Dict[str, Any], user_id: int, arg: str) -> Reply:
+    return "🪙 *Крипта*", kb_crypto_menu()
+
+def btn_crypto_market(st: Dict[str, Any], user_id: int, arg: str) -> Reply:
+    return crypto_market_text(), kb_crypto_menu()
+
+def btn_crypto_port(st: Dict[str, Any], user_id: int, arg: str) -> Reply:
+    return crypto_port_text(user_id), kb_crypto_menu()
+
+def btn_crypto_buy_menu(st: Dict[str, Any], user_id: int, arg: str) -> Reply:
+    return "🟢 *Купить* — выбери актив", kb_crypto_pick("buy")
+
+def btn_crypto_sell_menu(st: Dict[str, Any], user_id: int, arg: str) -> Reply:
+    return "🔴 *Продать* — выбери актив", kb_crypto_pick("sell")
+
+def btn_crypto_buy(st: Dict[str, Any], user_id: int, arg: str) -> Reply:
+    return f"🟢 Купить {arg}: выбери сумму", kb_crypto_amount("buy", arg)
+
+def btn_crypto_sell(st: Dict[str, Any], user_id: int, arg: str) -> Reply:
+    return f"🔴 Продать {arg}: выбери долю", kb_crypto_amount("sell", arg)
+
+def btn_crypto_buy_do(st: Dict[str, Any], user_id: int, arg: str) -> Reply:
+    sym, amt = arg.split("|")
+    return crypto_buy(st, user_id, sym, int(float(amt))), kb_crypto_menu()
+
+def btn_crypto_sell_do(st: Dict[str, Any], user_id: int, arg: str) -> Reply:
+    sym, frac = arg.split("|")
+    return crypto_sell(st, user_id, sym, float(frac)), kb_crypto_menu()
+
+def btn_sleep(st: Dict[str, Any], user_id: int, arg: str) -> Reply:
+    return do_sleep(st, user_id), kb_main()
+
+def btn_event(st: Dict[str, Any], user_id: int, arg: str) -> Reply:
+    return do_event(st), kb_main()
+
+BUTTONS = {
+    "noop": btn_noop,
+    "back": btn_back,
+    "status": btn_status,
+    "inv": btn_inv,
+    "eat_menu": btn_eat_menu,
+    "eat_inv": btn_eat_inv,
+    "eat_cafe": btn_eat_cafe,
+    "work_menu": btn_work_menu,
+    "job_set": btn_job_set,
+    "work_do": btn_work_do,
+    "biz_menu": btn_biz_menu,
+    "biz_shop": btn_biz_shop,
+    "biz_my": btn_biz_my,
+    "biz_buy": btn_biz_buy,
+    "biz_up": btn_biz_up,
+    "biz_view": btn_biz_view,
+    "crypto_menu": btn_crypto_menu,
+    "crypto_market": btn_crypto_market,
+    "crypto_port": btn_crypto_port,
+    "crypto_buy_menu": btn_crypto_buy_menu,
+    "crypto_sell_menu": btn_crypto_sell_menu,
+    "crypto_buy": btn_crypto_buy,
+    "crypto_sell": btn_crypto_sell,
+    "crypto_buy_do": btn_crypto_buy_do,
+    "crypto_sell_do": btn_crypto_sell_do,
+    "sleep": btn_sleep,
+    "event": btn_event,
+}
 
-    save_user(user_id, st)
+def process_click(user_id: int, data: str) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    # one BEGIN IMMEDIATE ... COMMIT per press. The user row is normally write-behind, but a
+    # click that also wrote another table (a purchase, a trade, payouts) flushes it in this
+    # same transaction, so the money and what it paid for always commit together.
+    cached, pending = _USER_CACHE.get(user_id), _PENDING_USERS.get(user_id)
+    try:
+        with transaction() as conn:
+            st = get_user(user_id) or default_state()
+
+            note = apply_decay(st)
+            if st["health"] <= 0:
+                save_user(user_id, st)
+                return "💀 Ты умер(ла). Нажми /start.", None
+
+            action, _, arg = data.partition("|")
+            handler = BUTTONS.get(action)
+            changes = conn.total_changes
+            if handler is None:
+                msg, kb = "🤔 Не понял кнопку.", kb_main()
+            else:
+                msg, kb = handler(st, user_id, arg)
+            wrote_other = conn.total_changes != changes
+
+            save_user(user_id, st)
+            if wrote_other:
+                flush_users()
+    except BaseException:
+        _restore_user(user_id, cached, pending)  # rolled back: the click never happened
+        raise
+
+    # one join instead of a chain of + that allocates an intermediate string per step
+    full = "".join((
+        "🖤 *dark Life*\n",
+        f"{note}\n\n" if note else "",
+        msg,
+        "\n\n",
+        render(st),
+        "\nВыбирай действие 👇",
+    ))
+    return full, kb
+
+# chat_id -> (message_id, hash of text + keyboard) of the last edit we made there (LRU)
+LAST_SENT_SIZE = 10_000
+_LAST_SENT: "OrderedDict[int, Tuple[int, int]]" = OrderedDict()
+
+# chat_id -> [lock, tasks holding or waiting for it]; dropped when the last one leaves
+_CHAT_LOCKS: Dict[int, List[Any]] = {}
+
+@asynccontextmanager
+async def chat_turn(chat_id: int) -> AsyncIterator[None]:
+    # asyncio.Lock wakes waiters first come, first served
+    entry = _CHAT_LOCKS.get(chat_id)
+    if entry is None:
+        entry = _CHAT_LOCKS[chat_id] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _CHAT_LOCKS[chat_id]
 
-    full = (
-        "🖤 *dark Life*\n"
-        + (f"{note}\n\n" if note else "")
-        + msg
-        + "\n\n"
-        + render(st)
-        + "\nВыбирай действие 👇"
-    )
-    await q.edit_message_text(full, parse_mode="Markdown", reply_markup=kb)
+async def on_btn(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    q = update.callback_query
+    m = q.message
+    # updates run concurrently, so queue the click before the first await: the DB thread
+    # applies one user's taps in the order they arrived, however slow each answer() is
+    result = run_db(process_click, q.from_user.id, q.data or "")
+
+    # and the chat's edits go out in that same order, so a stale screen never lands last
+    async with chat_turn(m.chat_id if m is not None else q.from_user.id):
+        await q.answer()
+        text, kb = await result
+
+        sent = (m.message_id, hash((text, kb))) if m is not None else None
+        if sent is not None and _LAST_SENT.get(m.chat_id) == sent:
+            return  # message already shows exactly this: skip the API round trip
+        try:
+            if kb is None:
+                await q.edit_message_text(text)
+            else:
+                await q.edit_message_text(text, parse_mode="Markdown", reply_markup=kb)
+        except BadRequest as e:
+            if "not modified" not in str(e):
+                raise
+        if sent is not None:
+            _LAST_SENT[m.chat_id] = sent
+            _LAST_SENT.move_to_end(m.chat_id)
+            if len(_LAST_SENT) > LAST_SENT_SIZE:
+                _LAST_SENT.popitem(last=False)
+
+async def on_startup(app: Application) -> None:
+    global _FLUSH_WAKE, _FLUSH_TASK, _FLUSH_LOOP
+    _FLUSH_LOOP = asyncio.get_running_loop()
+    _FLUSH_WAKE = asyncio.Event()
+    _FLUSH_TASK = asyncio.create_task(user_flusher())
+
+async def on_shutdown(app: Application) -> None:
+    global _FLUSH_WAKE, _FLUSH_TASK
+    if _FLUSH_TASK is not None:
+        _FLUSH_TASK.cancel()
+        _FLUSH_TASK = None
+    _FLUSH_WAKE = None
+    await run_db(flush_users)
+    await run_db(close_db)
+    DB_EXECUTOR.shutdown()
 
 def main() -> None:
     if not TOKEN:
         raise SystemExit("Set DARKLIFE_TOKEN env var.")
     init_db()
-    app = Application.builder().token(TOKEN).build()
+    app = (
+        Application.builder()
+        .token(TOKEN)
+        # pace outgoing edits under Telegram's flood limits instead of eating 429s
+        .rate_limiter(AIORateLimiter(max_retries=3))
+        # handle clicks side by side (PTB runs one update at a time by default): they only
+        # await the DB thread, which serializes every cache and SQLite access on its own;
+        # on_btn keeps each user's taps and each chat's edits in arrival order
+        .concurrent_updates(True)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     app.add_handler(CommandHandler("start", cmd_start))
     app.add_handler(CommandHandler("help", cmd_help))
     app.add_handler(CallbackQueryHandler(on_btn))